@@ -1,45 +1,91 @@
 import argparse
+import asyncio
+import email.utils
+import itertools
 import json
+import logging
 import math
+import multiprocessing
 import os
-import time
+import sqlite3
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Any
+from queue import SimpleQueue
+from typing import Any, Iterable, Iterator
 
+import aiohttp
 import googlemaps
-import h3
-
-# Google Places api response example:
-# {'business_status': 'OPERATIONAL',
-#  'geometry': {'location': {'lat': 37.5663339, 'lng': -122.3223532},
-#               'viewport': {'northeast': {'lat': 37.5674944302915,
-#                                          'lng': -122.3212776197085},
-#                            'southwest': {'lat': 37.5647964697085,
-#                                          'lng': -122.3239755802915}}},
-#  'icon': 'https://maps.gstatic.com/mapfiles/place_api/icons/v1/png_71/movies-71.png',
-#  'icon_background_color': '#13B5C7',
-#  'icon_mask_base_uri': 'https://maps.gstatic.com/mapfiles/place_api/icons/v2/movie_pinlet',
-#  'name': 'Cinemark Century San Mateo 12',
-#  'photos': [{'height': 2500,
-#              'html_attributions': ['<a '
-#                                    'href="https://maps.google.com/maps/contrib/111383913900870229200">Lawrence '
-#                                    'Marcus</a>'],
-#              'photo_reference': 'AVzFdbkewl2VtR33d_wzgh97eMyLYTqmMofO8k6I7DtGojPWLrrJKLIuLDrjvyo3gw4AKDZRfH101NHnPxWq8T11s7bhyGk_BflWY_35_YpUTmGFIkxWYYssDWbkUXXXUV7dPP6VCPxxdwnzKEQR4P0CY44CoWn-YwwJEKnC8ySlWJF4gUlJ',
-#              'width': 2268}],
-#  'place_id': 'ChIJd3dEm3Cej4ARl8USef836uE',
-#  'plus_code': {'compound_code': 'HM8H+G3 San Mateo, CA, USA',
-#                'global_code': '849VHM8H+G3'},
-#  'rating': 4.4,
-#  'reference': 'ChIJd3dEm3Cej4ARl8USef836uE',
-#  'scope': 'GOOGLE',
+import h3.api.basic_int as h3
+import ijson
+from aiolimiter import AsyncLimiter
+from pybloomfilter import BloomFilter
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from tqdm import tqdm
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+
+log = logging.getLogger("crawler")
+
+PLACES_NEARBY_URL = "https://places.googleapis.com/v1/places:searchNearby"
+# searchNearby has no pagination, a full page means there may be more places
+MAX_RESULTS = 20
+# only these fields are returned (and billed), see slim_place
+PLACES_FIELD_MASK = ",".join(
+    f"places.{field}"
+    for field in (
+        "id",
+        "displayName",
+        "shortFormattedAddress",
+        "location",
+        "rating",
+        "userRatingCount",
+        "types",
+    )
+)
+GEOCODE_CACHE_PATH = Path("~/.cache/gmaps_crawler/geocode.json").expanduser()
+REQUEST_TIMEOUT_S = 15
+CHECKPOINT_INTERVAL_S = 30
+RETRY_ATTEMPTS = 5
+# used when a 429 response doesn't say how long to wait
+RATE_LIMIT_BACKOFF_S = 5
+# past this much waiting on one request the key is assumed out of quota
+RATE_LIMIT_MAX_WAIT_S = 300
+# ~14.4 bits and 9 hashes per cell, ~3.6MB at capacity; past capacity the
+# false positive rate degrades gracefully
+CELL_BLOOM_CAPACITY = 2_000_000
+CELL_BLOOM_ERROR_RATE = 0.001
+
+# Google Places api (New) searchNearby place example, with the field mask above:
+# {'id': 'ChIJd3dEm3Cej4ARl8USef836uE',
 #  'types': ['movie_theater',
 #            'meal_takeaway',
 #            'restaurant',
 #            'food',
 #            'point_of_interest',
 #            'establishment'],
-#  'user_ratings_total': 1822,
-#  'vicinity': '320 2nd Avenue, San Mateo'}
+#  'location': {'latitude': 37.5663339, 'longitude': -122.3223532},
+#  'rating': 4.4,
+#  'userRatingCount': 1822,
+#  'displayName': {'text': 'Cinemark Century San Mateo 12', 'languageCode': 'en'},
+#  'shortFormattedAddress': '320 2nd Avenue, San Mateo'}
 
 # https://t1nak.github.io/blog/2020/h3intro/
 h3_resolution_to_edge_length_in_meters = {
@@ -53,14 +99,23 @@ h3_resolution_to_edge_length_in_meters = {
     # 14: 1.3486,
     # 15: 0.5197,
 }
+# the finest resolution searched, hexes that overflow here aren't split further
+MAX_RESOLUTION = max(h3_resolution_to_edge_length_in_meters)
+
+
+def _k_distance(h_resolution: int, distance_meters: int) -> int:
+    return math.floor(
+        distance_meters / h3_resolution_to_edge_length_in_meters[h_resolution]
+    )
 
 
-def get_hex_centers(
+def iter_hex_cells(
     lat: float, lng: float, distance_meters: int, h_resolution: int
-) -> tuple[tuple[float, float]]:
+) -> Iterator[int]:
     """
-    returns a list of latitude and longitude centroids based on
-    distance_meters and h3 resolution
+    lazily yields the h3 cells within distance_meters of lat, lng so they can
+    be filtered and dispatched one at a time; centroids are only looked up
+    for cells that actually get searched
 
     :param lat: latitude center
     :param lng: longitude center
@@ -68,17 +123,38 @@ def get_hex_centers(
     :param h_resolution:
     :return:
     """
-    k_distance = math.floor(
-        distance_meters / h3_resolution_to_edge_length_in_meters[h_resolution]
-    )
+    k_distance = _k_distance(h_resolution, distance_meters)
     hex_origin = h3.latlng_to_cell(lat, lng, h_resolution)
     hexes = h3.grid_disk(hex_origin, k_distance)  # Get surrounding hexagons
-    hex_centroids = tuple(h3.cell_to_latlng(h) for h in hexes)
-    print(
-        f"Broke up {lat},{lng},r={distance_meters} to {len(hex_centroids)} "
-        f"hexes of {k_distance} hops with radius={h3_resolution_to_edge_length_in_meters[h_resolution]}m"
+    log.info(
+        "Broke up %s,%s,r=%s to %d hexes of %d hops with radius=%sm",
+        lat,
+        lng,
+        distance_meters,
+        len(hexes),
+        k_distance,
+        h3_resolution_to_edge_length_in_meters[h_resolution],
     )
-    return hex_centroids  # noqa
+    yield from hexes
+
+
+def crawl_area(
+    lat: float, lng: float, distance_meters: int, h_resolution: int
+) -> set[int]:
+    """
+    the seed cells of iter_hex_cells plus one more ring. h3 children don't
+    nest exactly inside their parent, but a point in any descendant's area
+    falls within one ring of the seed it was queued under
+
+    :param lat: latitude center
+    :param lng: longitude center
+    :param distance_meters: distance in meters to generate cells
+    :param h_resolution:
+    :return:
+    """
+    k_distance = _k_distance(h_resolution, distance_meters)
+    hex_origin = h3.latlng_to_cell(lat, lng, h_resolution)
+    return set(h3.grid_disk(hex_origin, k_distance + 1))
 
 
 def geocode(gclient: Any, zipcode: str):
@@ -91,71 +167,798 @@ def geocode(gclient: Any, zipcode: str):
     return loc["lat"], loc["lng"]
 
 
-def get_places(gclient: Any, lat: float, lng: float, radius_m: int):
-    next_page_token = None
-    places = []
-    while True:
-        places_result = gclient.places_nearby(
-            location=(lat, lng),
-            radius=radius_m,
-            type="restaurant",
-            page_token=next_page_token,
+def cached_geocode(api_key: str, zipcode: str, cache_path: Path = GEOCODE_CACHE_PATH):
+    """
+    geocodes a zip code, reusing the result from earlier runs since a zip
+    code's location doesn't change
+
+    :param api_key: google maps api key, only used on a cache miss
+    :param zipcode: zip code to geocode
+    :param cache_path: json file mapping normalized zip code -> [lat, lng]
+    :return:
+    """
+    zip_key = zipcode.strip().upper()
+    cache = json_loads(cache_path.read_bytes()) if cache_path.exists() else {}
+    if zip_key in cache:
+        lat, lng = cache[zip_key]
+        log.info("Using cached location for %s: %s,%s", zip_key, lat, lng)
+        return lat, lng
+
+    lat, lng = geocode(googlemaps.Client(key=api_key), zip_key)
+    cache[zip_key] = [lat, lng]
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # write-then-rename so an interrupted write never corrupts the cache
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent)
+    with os.fdopen(fd, "wb") as fh:
+        fh.write(json_dumps(cache))
+    os.replace(tmp_path, cache_path)
+    return lat, lng
+
+
+def slim_place(place: dict) -> dict:
+    """
+    flattens a places api result into the record the crawler stores
+
+    :param place: places api result, see the example above
+    :return:
+    """
+    loc = place["location"]
+    return {
+        "place_id": place["id"],
+        "name": place.get("displayName", {}).get("text"),
+        "vicinity": place.get("shortFormattedAddress"),
+        "lat": loc["latitude"],
+        "lng": loc["longitude"],
+        "rating": place.get("rating"),
+        "user_ratings_total": place.get("userRatingCount"),
+        "types": place.get("types", []),
+    }
+
+
+class CrawlStore:
+    """
+    sqlite storage for places and crawled h3 cells. places and cells live on
+    disk only; a bloom filter over the crawled cells answers most "not crawled
+    yet" lookups without touching sqlite. places are stored slimmed down by
+    slim_place unless full is set. writes are committed by flush(), so cells
+    and the places they produced land atomically. children queued under an
+    overflowing hex are kept in pending until crawled, so an interrupted
+    crawl can pick its unfinished subtrees back up. crawled_db_path attaches
+    another store's database read-only, e.g. the parent's for a shard, whose
+    crawled and pending cells count as this store's
+    """
+
+    def __init__(
+        self, db_path: Path, full: bool = False, crawled_db_path: Path | None = None
+    ):
+        self.full = full
+        # uri=True lets the crawled database be attached read-only
+        self._conn = sqlite3.connect(db_path, uri=True)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS places("
+            "place_id TEXT PRIMARY KEY, lat REAL, lng REAL, name TEXT, "
+            "vicinity TEXT, blob BLOB)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cells(cell INTEGER PRIMARY KEY)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending(cell INTEGER PRIMARY KEY)"
+        )
+        self._crawled_tables = ["cells"]
+        self._pending_tables = ["pending"]
+        if crawled_db_path is not None:
+            self._conn.execute(
+                "ATTACH DATABASE ? AS crawled",
+                (f"{crawled_db_path.resolve().as_uri()}?mode=ro",),
+            )
+            self._crawled_tables.append("crawled.cells")
+            self._pending_tables.append("crawled.pending")
+        self._crawled = BloomFilter(CELL_BLOOM_CAPACITY, CELL_BLOOM_ERROR_RATE)
+        for table in self._crawled_tables:
+            self._crawled.update(
+                row[0] for row in self._conn.execute(f"SELECT cell FROM {table}")
+            )
+
+    @property
+    def place_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+
+    @property
+    def cell_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM cells").fetchone()[0]
+
+    def crawled_cells(self) -> Iterator[int]:
+        return (row[0] for row in self._conn.execute("SELECT cell FROM cells"))
+
+    def pending_cells(self) -> list[int]:
+        # materialized, the table changes as the crawl works through it
+        return [
+            row[0]
+            for row in self._conn.execute(
+                " UNION ".join(f"SELECT cell FROM {t}" for t in self._pending_tables)
+            )
+        ]
+
+    def is_crawled(self, cell: int) -> bool:
+        # the bloom filter has no false negatives, only positives need checking
+        return cell in self._crawled and any(
+            self._conn.execute(f"SELECT 1 FROM {t} WHERE cell = ?", (cell,)).fetchone()
+            for t in self._crawled_tables
+        )
+
+    def add_places(self, places: list[dict]) -> list[dict]:
+        """
+        inserts places not seen before and returns them
+        """
+        new_places = []
+        for place in places:
+            record = slim_place(place)
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO places VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    record["place_id"],
+                    record["lat"],
+                    record["lng"],
+                    record["name"],
+                    record["vicinity"],
+                    json_dumps(place if self.full else record),
+                ),
+            )
+            if cursor.rowcount:
+                new_places.append(place)
+        return new_places
+
+    @property
+    def field_mask(self) -> str:
+        """
+        the place fields to request: those slim_place keeps, or all of them
+        when storing full results
+        """
+        return "*" if self.full else PLACES_FIELD_MASK
+
+    def add_cell(self, cell: int):
+        self.add_cells((cell,))
+
+    def add_cells(self, cells: Iterable[int]):
+        cells = list(cells)
+        self._crawled.update(cells)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO cells VALUES (?)", ((c,) for c in cells)
+        )
+        self._conn.executemany(
+            "DELETE FROM pending WHERE cell = ?", ((c,) for c in cells)
+        )
+
+    def add_pending(self, cells: Iterable[int]):
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO pending VALUES (?)", ((c,) for c in cells)
         )
-        next_page_token = places_result.get("next_page_token")
-        places.extend(places_result["results"])
 
-        time.sleep(2)  # google rate-limits
-        if not next_page_token:
+    def flush(self):
+        self._conn.commit()
+
+    def merge(self, other_path: Path):
+        """
+        folds another store's database (e.g. a shard spool) into this one and
+        deletes it
+        """
+        self.flush()
+        self._conn.execute("ATTACH DATABASE ? AS other", (str(other_path),))
+        try:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO places SELECT * FROM other.places"
+            )
+            self._crawled.update(
+                row[0] for row in self._conn.execute("SELECT cell FROM other.cells")
+            )
+            self._conn.execute("INSERT OR IGNORE INTO cells SELECT * FROM other.cells")
+            self._conn.execute(
+                "INSERT OR IGNORE INTO pending SELECT * FROM other.pending"
+            )
+            self._conn.execute(
+                "DELETE FROM pending WHERE cell IN (SELECT cell FROM other.cells)"
+            )
+            self.flush()
+        finally:
+            self._conn.execute("DETACH DATABASE other")
+        other_path.unlink()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class CandidateCoverage:
+    """
+    h3 cells, at every resolution the crawl searches, that contain at least
+    one known candidate point (e.g. an OSM or Overture restaurant extract).
+    hexes outside it are assumed empty and never cost a places request
+    """
+
+    def __init__(
+        self,
+        lats: Iterable[float],
+        lngs: Iterable[float],
+        area: set[int] | None = None,
+    ):
+        """
+        :param lats: candidate latitudes
+        :param lngs: candidate longitudes
+        :param area: cells of a single resolution bounding the crawl, see
+            crawl_area; candidates outside it are dropped
+        :return:
+        """
+        resolutions = sorted(h3_resolution_to_edge_length_in_meters)
+        area_resolution = h3.get_resolution(next(iter(area))) if area else None
+        self._cells = set()
+        for lat, lng in zip(lats, lngs):
+            if area and h3.latlng_to_cell(lat, lng, area_resolution) not in area:
+                continue
+            # cells don't nest exactly, so each resolution is looked up directly
+            # rather than taking parents of the finest cell
+            self._cells.update(h3.latlng_to_cell(lat, lng, res) for res in resolutions)
+
+    def __contains__(self, cell: int) -> bool:
+        return cell in self._cells
+
+    @classmethod
+    def from_parquet(
+        cls, path: Path, area: set[int] | None = None
+    ) -> "CandidateCoverage":
+        """
+        :param path: parquet file with lat and lng columns
+        :param area: see __init__
+        :return:
+        """
+        # imported here so runs without --candidates don't pay for pyarrow
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("pyarrow is required to read --candidates")
+        table = pq.read_table(path, columns=["lat", "lng"])
+        return cls(
+            table.column("lat").to_pylist(), table.column("lng").to_pylist(), area
+        )
+
+
+class PlacesApiError(Exception):
+    def __init__(self, status: str, message: str = "", http_status: int = 0):
+        super().__init__(f"Places API error {status}: {message}")
+        self.status = status
+        self.http_status = http_status
+
+
+class RateLimitedError(PlacesApiError):
+    def __init__(self, status: str, message: str = "", retry_after: float = 0):
+        super().__init__(status, message, http_status=429)
+        self.retry_after = retry_after
+
+
+def _is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, RateLimitedError):
+        return False  # waited out by get_places_async, not a retry attempt
+    if isinstance(exc, PlacesApiError):
+        return exc.http_status >= 500
+    # aiohttp times out with asyncio.TimeoutError, only an alias from 3.11 on
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def _retry_after_s(retry_after: str | None) -> float:
+    """
+    seconds to wait from a Retry-After header, either delay-seconds or an
+    HTTP-date. never less than a second, so a zero or past value doesn't
+    turn into a tight retry loop
+    """
+    if not retry_after:
+        return RATE_LIMIT_BACKOFF_S
+    try:
+        return max(1.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return RATE_LIMIT_BACKOFF_S
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(1.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+@retry(
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=10),
+    retry=retry_if_exception(_is_transient),
+    before_sleep=lambda state: log.warning(
+        "Retrying places request after %r (attempt %d/%d)",
+        state.outcome.exception(),
+        state.attempt_number,
+        RETRY_ATTEMPTS,
+    ),
+    reraise=True,
+)
+async def _search_nearby(
+    session: aiohttp.ClientSession, body: dict, headers: dict, limiter: AsyncLimiter
+) -> list[dict]:
+    async with limiter:
+        async with session.post(
+            PLACES_NEARBY_URL, data=json_dumps(body), headers=headers
+        ) as resp:
+            if resp.status != 200:
+                try:
+                    payload = await resp.json(loads=json_loads, content_type=None)
+                except ValueError:
+                    payload = None
+                # error bodies can be empty or not json at all, e.g. from a proxy
+                error = payload.get("error") if isinstance(payload, dict) else None
+                if not isinstance(error, dict):
+                    error = {}
+                status = error.get("status", str(resp.status))
+                message = error.get("message", "")
+                if resp.status == 429:
+                    raise RateLimitedError(
+                        status, message, _retry_after_s(resp.headers.get("Retry-After"))
+                    )
+                raise PlacesApiError(status, message, resp.status)
+            # decode places as the body arrives rather than buffering it first
+            return [
+                place
+                async for place in ijson.items(
+                    resp.content, "places.item", use_float=True
+                )
+            ]
+
+
+async def get_places_async(
+    session: aiohttp.ClientSession,
+    api_key: str,
+    lat: float,
+    lng: float,
+    radius_m: int,
+    limiter: AsyncLimiter,
+    field_mask: str = PLACES_FIELD_MASK,
+) -> list[dict]:
+    """
+    returns the places (up to google's limit of MAX_RESULTS) found within
+    radius_m of lat, lng. transient failures are retried with jittered
+    exponential backoff, rate limiting is waited out without using up retries
+    for up to RATE_LIMIT_MAX_WAIT_S before giving up
+
+    :param session: shared aiohttp session
+    :param api_key: google maps api key
+    :param lat: latitude center
+    :param lng: longitude center
+    :param radius_m: search radius in meters
+    :param limiter: global QPS ceiling shared by every request
+    :param field_mask: place fields to return
+    :return:
+    """
+    body = {
+        "includedTypes": ["restaurant"],
+        "maxResultCount": MAX_RESULTS,
+        "locationRestriction": {
+            "circle": {
+                "center": {"latitude": lat, "longitude": lng},
+                "radius": float(radius_m),
+            }
+        },
+    }
+    headers = {"X-Goog-Api-Key": api_key, "X-Goog-FieldMask": field_mask}
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + RATE_LIMIT_MAX_WAIT_S
+    while True:
+        try:
+            places = await _search_nearby(session, body, headers, limiter)
             break
+        except RateLimitedError as e:
+            # e.g. RESOURCE_EXHAUSTED once the key's daily quota is used up
+            if loop.time() + e.retry_after > give_up_at:
+                raise
+            log.warning("Rate limited, waiting %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after)
 
-    print(f"Found a total of {len(places)} places at {lat}, {lng} radius={radius_m}m")
+    log.info(
+        "Found a total of %d places at %s, %s radius=%sm",
+        len(places),
+        lat,
+        lng,
+        radius_m,
+    )
     return places
 
 
-def search_radius(
-    search_lat,
-    search_long,
-    h_resolution: int,
-    radius_m: int,
-    dict_storage: dict,
-    seen_locations: set,
+def enqueue_children(
+    queue: asyncio.Queue,
+    parent_cell: int,
+    store: CrawlStore,
+    inflight: set[int],
+    progress: tqdm,
+    coverage: CandidateCoverage | None = None,
 ):
-    print(f"Searching radius...{search_lat},{search_long}, r={radius_m}m")
-    hex_radius = math.ceil(h3_resolution_to_edge_length_in_meters[h_resolution])
-    hex_coords = get_hex_centers(search_lat, search_long, radius_m, h_resolution)
-    num_hex_coords = len(hex_coords)
-
-    for i, (hex_lat, hex_lng) in enumerate(hex_coords):
-        print(f"{i + 1}/{num_hex_coords} @ {hex_lat},{hex_lng}")
-        if (hex_lat, hex_lng) in seen_locations:
-            print("  - skipping")
+    """
+    queues the children of a hex one resolution down that aren't crawled,
+    already queued or outside coverage. children tile the parent exactly,
+    unlike a k_distance disk. queued children are recorded as pending so
+    they outlive an interrupted crawl
+
+    :param queue: work queue of (cell, is_seed) items
+    :param parent_cell: h3 cell id to subdivide
+    :param store: crawl storage, used to skip crawled cells
+    :param inflight: cells queued or being searched
+    :param progress: progress bar over queued hexes
+    :param coverage: cells known to hold candidates, None searches every cell
+    :return:
+    """
+    children = h3.cell_to_children(parent_cell, h3.get_resolution(parent_cell) + 1)
+    queued = []
+    for cell in children:
+        if cell in inflight or store.is_crawled(cell):
             continue
+        if coverage is not None and cell not in coverage:
+            continue
+        # claim the cell so overlapping searches don't request it concurrently
+        inflight.add(cell)
+        queue.put_nowait((cell, False))
+        queued.append(cell)
+    store.add_pending(queued)
+    progress.total += len(queued)
+    progress.refresh()
+    log.info(
+        "Queued %d/%d children, skipping %d already crawled, in flight or empty",
+        len(queued),
+        len(children),
+        len(children) - len(queued),
+    )
+
+
+async def feed_seeds(
+    queue: asyncio.Queue,
+    seeds: Iterable[int],
+    store: CrawlStore,
+    inflight: set[int],
+    progress: tqdm,
+    seed_slots: asyncio.Semaphore,
+    coverage: CandidateCoverage | None = None,
+):
+    """
+    pulls seed cells into the work queue as workers free up seed_slots, so
+    only a handful of seeds are ever materialized at once
+    """
+    for cell in seeds:
+        if cell in inflight or store.is_crawled(cell):
+            continue
+        if coverage is not None and cell not in coverage:
+            continue
+        await seed_slots.acquire()
+        inflight.add(cell)
+        queue.put_nowait((cell, True))
+        progress.total += 1
+        progress.refresh()
 
-        places_found = get_places(client, hex_lat, hex_lng, hex_radius)
-        for place in places_found:
-            if place["place_id"] not in dict_storage:
-                print(
-                    f"{place['name']:<30} {place['vicinity']:<40} {place['geometry']['location']}"
-                )
-                dict_storage[place["place_id"]] = place
-            else:
-                print(f"Skipping duplicate {place['name']:<30} {place['vicinity']:<40}")
 
-        if len(places_found) == 60:
-            print(
-                "Warning: found maximum number of places, recursing into ",
-                f"lat:{hex_lat} lng:{hex_lng}, radius_m:{hex_radius}",
+async def search_worker(
+    queue: asyncio.Queue,
+    session: aiohttp.ClientSession,
+    api_key: str,
+    store: CrawlStore,
+    inflight: set[int],
+    limiter: AsyncLimiter,
+    progress: tqdm,
+    seed_slots: asyncio.Semaphore,
+    coverage: CandidateCoverage | None = None,
+):
+    """
+    drains hexes from the work queue, queueing the next resolution down for
+    any hex that hits google's MAX_RESULTS limit, down to MAX_RESOLUTION
+    """
+    while True:
+        cell, is_seed = await queue.get()
+        try:
+            h_resolution = h3.get_resolution(cell)
+            hex_lat, hex_lng = h3.cell_to_latlng(cell)
+            hex_radius = math.ceil(
+                h3_resolution_to_edge_length_in_meters[h_resolution]
             )
-            search_radius(
+            places_found = await get_places_async(
+                session,
+                api_key,
                 hex_lat,
                 hex_lng,
-                h_resolution + 1,
                 hex_radius,
-                dict_storage,
-                seen_locations,
+                limiter,
+                field_mask=store.field_mask,
+            )
+            new_places = store.add_places(places_found)
+            for place in new_places:
+                # formatted lazily on the log listener thread, see setup_logging
+                log.info(
+                    "%-30s %-40s %s",
+                    place.get("displayName", {}).get("text", ""),
+                    place.get("shortFormattedAddress", ""),
+                    place["location"],
+                )
+            log.info(
+                "Skipped %d duplicate places", len(places_found) - len(new_places)
+            )
+
+            if len(places_found) == MAX_RESULTS and h_resolution >= MAX_RESOLUTION:
+                log.warning(
+                    "Found maximum number of places at the finest resolution, "
+                    "some may be missing around lat:%s lng:%s, radius_m:%s",
+                    hex_lat,
+                    hex_lng,
+                    hex_radius,
+                )
+            elif len(places_found) == MAX_RESULTS:
+                log.warning(
+                    "Found maximum number of places, recursing into the "
+                    "children of lat:%s lng:%s, radius_m:%s",
+                    hex_lat,
+                    hex_lng,
+                    hex_radius,
+                )
+                enqueue_children(queue, cell, store, inflight, progress, coverage)
+
+            store.add_cell(cell)
+        finally:
+            inflight.discard(cell)
+            queue.task_done()
+            progress.update()
+            if is_seed:
+                seed_slots.release()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    enqueues records as-is; the stock QueueHandler renders the message on the
+    calling thread, this leaves it to the listener thread
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class TqdmHandler(logging.StreamHandler):
+    """
+    writes log records above the progress bar instead of through it
+    """
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            tqdm.write(self.format(record), file=self.stream)
+        except Exception:  # noqa
+            self.handleError(record)
+
+
+def setup_logging() -> QueueListener:
+    """
+    routes logging through a queue so crawl workers only enqueue records and
+    a background listener thread does the formatting and writing
+
+    :return: the started listener, stop it to drain remaining records
+    """
+    log_queue = SimpleQueue()
+    listener = QueueListener(log_queue, TqdmHandler())
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[DeferredQueueHandler(log_queue)],
+    )
+    listener.start()
+    return listener
+
+
+async def checkpointer(store: CrawlStore, interval_s: float):
+    while True:
+        await asyncio.sleep(interval_s)
+        store.flush()
+
+
+async def crawl(
+    api_key: str,
+    seeds: Iterable[int],
+    store: CrawlStore,
+    concurrency: int,
+    qps: float,
+    checkpoint_interval_s: float = CHECKPOINT_INTERVAL_S,
+    desc: str | None = None,
+    coverage: CandidateCoverage | None = None,
+):
+    """
+    breadth-first crawl: seed cells (see iter_hex_cells) are fed into a work
+    queue that concurrency workers drain, with overflowing hexes queued back
+    in at the next resolution. with coverage, hexes without candidates are
+    skipped
+    """
+    queue = asyncio.Queue()
+    inflight = set()
+    limiter = AsyncLimiter(qps, 1)
+    seed_slots = asyncio.Semaphore(2 * concurrency)
+    progress = tqdm(total=0, unit="hex", desc=desc)
+
+    async def drain():
+        await feed_seeds(
+            queue, seeds, store, inflight, progress, seed_slots, coverage
+        )
+        await queue.join()
+
+    # one pooled, keep-alive connector for the whole crawl so hexes reuse
+    # established TLS connections instead of handshaking per request
+    connector = aiohttp.TCPConnector(
+        limit=32, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=60
+    )
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S),
+    ) as session:
+        workers = [
+            asyncio.create_task(
+                search_worker(
+                    queue,
+                    session,
+                    api_key,
+                    store,
+                    inflight,
+                    limiter,
+                    progress,
+                    seed_slots,
+                    coverage,
+                )
             )
+            for _ in range(concurrency)
+        ]
+        workers.append(
+            asyncio.create_task(checkpointer(store, checkpoint_interval_s))
+        )
+        join = asyncio.create_task(drain())
+        try:
+            await asyncio.wait([join, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for task in (join, *workers):
+                if task.done():
+                    task.result()  # re-raises a failed feeder or worker
+        finally:
+            # also reached on KeyboardInterrupt; uncrawled seeds and pending
+            # children are retried on the next run and buffered records are
+            # flushed by store.close()
+            for task in (join, *workers):
+                task.cancel()
+            await asyncio.gather(join, *workers, return_exceptions=True)
+            progress.close()
+
+
+def _init_shard_logging():
+    # the parent's queue listener doesn't exist in the worker process
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(processName)s] %(message)s",
+        handlers=[TqdmHandler()],
+        force=True,
+    )
+
+
+def shard_db_path(db_path: Path, shard: int) -> Path:
+    return db_path.with_suffix(f".shard{shard}.db")
 
-        seen_locations.add((hex_lat, hex_lng))
+
+def run_shard(
+    api_key: str,
+    shard: int,
+    shards: int,
+    lat: float,
+    lng: float,
+    distance_meters: int,
+    h_resolution: int,
+    db_path: Path,
+    crawled_db_path: Path,
+    full: bool,
+    concurrency: int,
+    qps: float,
+    checkpoint_interval_s: float,
+    candidates_path: Path | None = None,
+) -> int:
+    """
+    crawls every shards-th seed hex, starting at shard, in a worker process.
+    seeds are generated here rather than shipped over, crawled cells are
+    looked up in the parent's database and results are spooled to the
+    shard's own database for the parent to merge
+
+    :return: number of places the shard found
+    """
+    shard_store = CrawlStore(db_path, full=full, crawled_db_path=crawled_db_path)
+    coverage = None
+    if candidates_path:
+        coverage = CandidateCoverage.from_parquet(
+            candidates_path, crawl_area(lat, lng, distance_meters, h_resolution)
+        )
+    # a hex's children are disjoint from every other seed's, so partitioning
+    # the seeds (and pending children) is enough to keep shards apart
+    seeds = itertools.islice(
+        itertools.chain(
+            shard_store.pending_cells(),
+            iter_hex_cells(lat, lng, distance_meters, h_resolution),
+        ),
+        shard,
+        None,
+        shards,
+    )
+    try:
+        asyncio.run(
+            crawl(
+                api_key,
+                seeds,
+                shard_store,
+                concurrency,
+                qps,
+                checkpoint_interval_s,
+                desc=f"shard {shard}",
+                coverage=coverage,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        place_count = shard_store.place_count
+        shard_store.close()
+    return place_count
+
+
+def crawl_sharded(
+    api_keys: list[str],
+    lat: float,
+    lng: float,
+    distance_meters: int,
+    h_resolution: int,
+    store: CrawlStore,
+    db_path: Path,
+    full: bool,
+    concurrency: int,
+    qps: float,
+    checkpoint_interval_s: float,
+    candidates_path: Path | None = None,
+):
+    """
+    partitions the seed hexes round-robin across one process per api key,
+    each with its own session and per-key qps, then merges the shard spools
+    into store. shards only get the seed parameters and paths, not the
+    crawled cells or coverage themselves
+    """
+    spools = [shard_db_path(db_path, i) for i in range(len(api_keys))]
+    # shards read crawled and pending cells straight from db_path
+    store.flush()
+    try:
+        # spawn, not fork: the parent has a live sqlite connection and the log
+        # listener thread, neither of which is safe to carry into a child
+        with ProcessPoolExecutor(
+            max_workers=len(api_keys),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard_logging,
+        ) as executor:
+            futures = [
+                executor.submit(
+                    run_shard,
+                    key,
+                    i,
+                    len(api_keys),
+                    lat,
+                    lng,
+                    distance_meters,
+                    h_resolution,
+                    spools[i],
+                    db_path,
+                    full,
+                    concurrency,
+                    qps,
+                    checkpoint_interval_s,
+                    candidates_path,
+                )
+                for i, key in enumerate(api_keys)
+            ]
+            for i, future in enumerate(futures):
+                log.info("Shard %d found %d places", i, future.result())
+    finally:
+        for spool in spools:
+            if spool.exists():
+                store.merge(spool)
 
 
 if __name__ == "__main__":
@@ -168,10 +971,49 @@ if __name__ == "__main__":
         help="resolution to start with, use a higher resolution for more dense areas.",
         default=8,
     )
-    api_key = os.getenv("API_KEY")
-    assert api_key, "API_KEY environment variable not set"
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="number of hexes to search at once",
+        default=5,
+    )
+    parser.add_argument(
+        "--qps",
+        type=float,
+        help="maximum places api requests per second, per api key when sharded "
+        "across several",
+        default=10,
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        help="seconds between flushes of crawl storage to disk",
+        default=CHECKPOINT_INTERVAL_S,
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="store the full places api result instead of the fields used",
+    )
+    parser.add_argument(
+        "--api-keys",
+        type=str,
+        help="comma separated api keys, the crawl is sharded across one process "
+        "per key. defaults to the API_KEY environment variable",
+    )
+    parser.add_argument(
+        "--candidates",
+        type=Path,
+        help="parquet file of lat/lng candidate points (e.g. an OSM or Overture "
+        "restaurant extract), only hexes containing one are searched",
+    )
 
     options = parser.parse_args()
+    api_keys = (
+        options.api_keys.split(",") if options.api_keys else [os.getenv("API_KEY")]
+    )
+    assert all(api_keys), "API_KEY environment variable not set"
+    log_listener = setup_logging()
     start_resolution = options.resolution
     search_radius_m = options.r
 
@@ -179,40 +1021,67 @@ if __name__ == "__main__":
         [options.zipcode, f"resolution{start_resolution}", f"radius{search_radius_m}"]
     )
 
-    crawled_locations = Path(f"coord_history_{filename_meta}.json")
-    if crawled_locations.exists():
-        crawled_store = set([tuple(t) for t in json.load(crawled_locations.open("r"))])
-    else:
-        crawled_store = set()
-
-    storage = Path(f"places_storage_{filename_meta}.json")
-    if storage.exists():
-        place_store = json.load(storage.open("r"))
-        print(f"Loaded storage with {len(place_store)} places")
-    else:
-        place_store = {}
+    db_path = Path(f"places_{filename_meta}.db")
+    store = CrawlStore(db_path, full=options.full)
+    # pick up spools left behind by a sharded run that didn't finish merging,
+    # which may have merged some shards already and so left gaps
+    for spool in sorted(db_path.parent.glob(f"{db_path.stem}.shard*.db")):
+        store.merge(spool)
+    log.info(
+        "Loaded storage with %d places and %d crawled cells",
+        store.place_count,
+        store.cell_count,
+    )
 
-    client = googlemaps.Client(key=api_key)
-    zip_lat, zip_lng = geocode(client, options.zipcode)
+    zip_lat, zip_lng = cached_geocode(api_keys[0], options.zipcode)
 
     try:
-        search_radius(
-            zip_lat,
-            zip_lng,
-            start_resolution,
-            search_radius_m,
-            place_store,
-            crawled_store,
-        )
+        if len(api_keys) > 1:
+            crawl_sharded(
+                api_keys,
+                zip_lat,
+                zip_lng,
+                search_radius_m,
+                start_resolution,
+                store,
+                db_path,
+                options.full,
+                options.concurrency,
+                options.qps,
+                options.checkpoint_interval,
+                options.candidates,
+            )
+        else:
+            coverage = None
+            if options.candidates:
+                coverage = CandidateCoverage.from_parquet(
+                    options.candidates,
+                    crawl_area(zip_lat, zip_lng, search_radius_m, start_resolution),
+                )
+                log.info("Loaded candidate coverage from %s", options.candidates)
+            # children left pending by an interrupted run go first, then the seeds
+            seeds = itertools.chain(
+                store.pending_cells(),
+                iter_hex_cells(zip_lat, zip_lng, search_radius_m, start_resolution),
+            )
+            asyncio.run(
+                crawl(
+                    api_keys[0],
+                    seeds,
+                    store,
+                    options.concurrency,
+                    options.qps,
+                    options.checkpoint_interval,
+                    coverage=coverage,
+                )
+            )
     except KeyboardInterrupt:
-        print("Keyboard Interrupt detected, flushing map.")
+        log.info("Keyboard Interrupt detected, stopping crawl.")
     finally:
-        with storage.open("w") as fh:
-            print(f"Flushing storage with {len(place_store)} places")
-            json.dump(place_store, fh)  # noqa
-
-        with crawled_locations.open("w") as fh:
-            print(
-                f"Flushing crawled store location with {len(crawled_store)} coordinates."
-            )
-            json.dump(list(crawled_store), fh)  # noqa
+        log.info(
+            "Stored %d places and %d crawled cells",
+            store.place_count,
+            store.cell_count,
+        )
+        store.close()
+        log_listener.stop()